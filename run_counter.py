@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
 import collections
 from functools import partial
 import http.server
@@ -8,17 +9,38 @@ import json
 import logging
 import logging.handlers
 import os
-import socketserver
+import queue
+import re
+import select
+import signal
+import socket
+import struct
+import sys
 import threading
 import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
 import serial
 
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None  # fall back to polling for the serial device
+
 
 DEFAULT_SERIAL_DEVICE = '/dev/ttyACM0'
 DEFAULT_STATE_FILE = 'pulse_counter.state'
 DEFAULT_LOG_FILE = 'pulse_counter.log'
 DEFAULT_PORT = 8000
+FLUSH_INTERVAL = 2.0  # maximum number of seconds between state saves
+FLUSH_PENDING = 100  # save early after this many unsaved increments
+RETRY_MIN_DELAY = 0.1  # seconds before reopening a device that is still present
+RETRY_MAX_DELAY = 10.0
+
+STATE_FORMAT = struct.Struct('<5q')  # state file: 5 little-endian 64-bit counters
+
+# ID:<device id>:I:<interval>, followed by M<n>:<pulses>:<total> for 5 counters
+TELEGRAM_RE = re.compile(r'ID:(\d+):[^:]*:(\d+)' + r':[^:]*:(\d+):(\d+)' * 5)
 
 
 LOG = logging.getLogger(__name__)
@@ -30,73 +52,185 @@ class PulseTelegram(collections.namedtuple('PulseTelegram', [
     'pulses',  # list of 5 counts since previous interval
     'pulses_total',  # list of 5 total counts since device boot
 ])):
-    def __repr__(self):
+    def __repr__(self) -> str:
         return f'PulseTelegram(device_id={self.device_id}; interval={self.interval}; pulses={",".join([str(p) for p in self.pulses])}; total={",".join([str(p) for p in self.pulses_total])})'
 
 
 class CounterStates:
-    def __init__(self, path: str):
-        self.path = path
-        self.states = [0] * 5
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL, flush_pending: int = FLUSH_PENDING):
+        self.path: str = path
+        # single-word counters: readers index them without taking the lock;
+        # the lock only guards updates and consistent snapshots of all five
+        self.states: array.array[int] = array.array('q', [0] * 5)
+        self.flush_interval: float = flush_interval
+        self.flush_pending: int = flush_pending
         self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty: bool = False
+        self._pending: int = 0
+        self._flush_event = threading.Event()
+        self._json_cache: Optional[bytes] = None
+        self._idx_cache: List[Optional[bytes]] = [None] * 5
         self.load_states()
 
-    def load_states(self):
+        self._flusher = threading.Thread(target=self._run_flusher, name='state-flusher', daemon=True)
+        self._flusher.start()
+
+    def load_states(self) -> bool:
         with self._lock:
             if not os.path.exists(self.path):
                 LOG.info('no state recoverd; counters reset')
                 return False
 
-            with open(self.path, 'rt') as f:
-                line = f.readline().strip().split(',')
-                self.states = [int(v) for v in line]
-                LOG.info(f'counters initialized at {",".join([str(v) for v in self.states])}')
-                return True
-
-    def save_states(self):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+
+            if data.strip().replace(b',', b'').isdigit():
+                # state file written by an older version, as comma separated text
+                line = data.decode('ascii').strip().split(',')
+                self.states = array.array('q', [int(v) for v in line])
+            else:
+                self.states = array.array('q', STATE_FORMAT.unpack(data))
+            self._json_cache = None
+            self._idx_cache = [None] * 5
+            LOG.info(f'counters initialized at {",".join([str(v) for v in self.states])}')
+            return True
+
+    def save_states(self) -> None:
+        with self._save_lock:
+            self._save_states()
+
+    def _save_states(self) -> None:
+        # caller holds _save_lock
+        # clear the flag before taking the snapshot: an increment in
+        # between marks the states dirty again rather than getting lost
         with self._lock:
-            try:
-                with open(self.path, 'wt') as f:
-                    f.write(','.join([str(v) for v in self.states]))
-            except Exception as e:
-                LOG.warning(f'failed to save counter states: {e}')
+            self._dirty = False
+            self._pending = 0
+        states = self.snapshot()
 
-    def increment(self, pulses):
+        try:
+            self._write_atomic(STATE_FORMAT.pack(*states))
+        except Exception as e:
+            LOG.warning(f'failed to save counter states: {e}')
+            with self._lock:
+                self._dirty = True
+
+    def _write_atomic(self, payload: bytes) -> None:
+        # write to a temporary file and move it into place, so that the state
+        # file is never left truncated if power is lost halfway
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+        dirfd = os.open(os.path.dirname(self.path) or '.', os.O_DIRECTORY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    def flush(self) -> None:
+        """Save the counter states now if there are unsaved increments."""
+        # wait for a save in progress, which already cleared the dirty flag
+        # but whose states may not be on disk yet
+        with self._save_lock:
+            if self._dirty:
+                self._save_states()
+
+    def _run_flusher(self) -> None:
+        while True:
+            self._flush_event.wait(timeout=self.flush_interval)
+            self._flush_event.clear()
+            self.flush()
+
+    def snapshot(self) -> Tuple[int, ...]:
+        """Return a consistent copy of all counter states."""
+        with self._lock:
+            return tuple(self.states)
+
+    def snapshot_one(self, n: int) -> int:
+        """Return the state of counter `n`; a single counter is read without locking."""
+        return self.states[n]
+
+    def json_bytes(self) -> bytes:
+        """Return all counter states as serialized JSON."""
+        c = self._json_cache
+        if c is None:
+            with self._lock:
+                c = self._json_cache
+                if c is None:
+                    c = self._json_cache = json.dumps(self.states.tolist()).encode('ascii')
+        return c
+
+    def idx_bytes(self, n: int) -> bytes:
+        """Return the state of counter `n` as serialized JSON."""
+        b = self._idx_cache[n]
+        if b is None:
+            with self._lock:
+                b = self._idx_cache[n]
+                if b is None:
+                    b = self._idx_cache[n] = str(self.snapshot_one(n)).encode('ascii')
+        return b
+
+    def increment(self, pulses: Sequence[int]) -> None:
+        if not any(pulses):
+            return
+
+        if LOG.isEnabledFor(logging.DEBUG):
+            for i, p in enumerate(pulses):
+                if p:
+                    LOG.debug('increment counter %d by %d', i, p)
+
+        p0, p1, p2, p3, p4 = pulses
         with self._lock:
-            for i in range(len(pulses)):
-                if pulses[i] > 0:
-                    LOG.debug(f'increment counter {i} by {pulses[i]}')
-                self.states[i] += pulses[i]
+            s = self.states
+            s[0] += p0
+            s[1] += p1
+            s[2] += p2
+            s[3] += p3
+            s[4] += p4
 
-        if sum(pulses) > 0:
-            self.save_states()
+            self._json_cache = None
+            self._idx_cache = [None] * 5
+            self._dirty = True
+            self._pending += 1
+            if self._pending >= self.flush_pending:
+                self._flush_event.set()
 
 
 class Handler(http.server.BaseHTTPRequestHandler):
-    def __init__(self, states: CounterStates, *args, **kwargs):
+    # request path -> counter index, or None for all counters
+    ROUTES: Dict[str, Optional[int]] = {'/': None, **{f'/{i}': i for i in range(5)}}
+
+    def __init__(self, states: CounterStates, *args: Any, **kwargs: Any) -> None:
         self.states = states
         super().__init__(*args, **kwargs)
 
-    def do_get_unsafe(self):
-        if self.path == '/':
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(self.states.states).encode('ascii'))
+    def setup(self) -> None:
+        super().setup()
+        # responses are tiny; send them right away instead of waiting for Nagle
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_get_unsafe(self) -> None:
+        try:
+            idx = self.ROUTES[self.path]
+        except KeyError:
+            if self.path[1:].isdigit():
+                raise IndexError(self.path[1:])
+            raise FileNotFoundError(self.path)
+
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.end_headers()
+        if idx is None:
+            self.wfile.write(self.states.json_bytes())
         else:
-            n = self.path[1:]
-            if not n.isdigit():
-                raise FileNotFoundError(self.path)
-            n = int(n)
-            if n >= len(self.states.states):
-                raise IndexError(n)
-
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(str(self.states.states[n]).encode('ascii'))
-
-    def send_error(self, code, message=None, explain=None):
+            self.wfile.write(self.states.idx_bytes(idx))
+
+    def send_error(self, code: int, message: Optional[str] = None, explain: Optional[str] = None) -> None:
         self.send_response(code)
         self.send_header("Content-type", "application/json")
         self.end_headers()
@@ -104,7 +238,7 @@ class Handler(http.server.BaseHTTPRequestHandler):
             self.wfile.write(json.dumps({'message': message}).encode('ascii'))
         
 
-    def do_GET(self):
+    def do_GET(self) -> None:
         try:
             self.do_get_unsafe()
         except FileNotFoundError:
@@ -116,38 +250,104 @@ class Handler(http.server.BaseHTTPRequestHandler):
             self.send_error(500, 'error')
 
 
-def read_serial(dev: serial.Serial, states: CounterStates):
+def read_lines(dev: serial.Serial) -> Iterator[str]:
+    """Yield lines from `dev`, reading up to 4 KiB per system call."""
+    # the port is opened non-blocking by pyserial, so wait for data first
+    fd = dev.fileno()
+    rlist = [fd]
+    wait, read = select.select, os.read
+    buf = b''
     while True:
-        line = dev.readline().decode('ascii').rstrip()
-        elems = line.split(':')
-        if len(elems) == 2 and elems[0] == '/42001':
+        try:
+            wait(rlist, [], [])
+            chunk = read(fd, 4096)
+        except BlockingIOError:
+            continue  # spurious wakeup; no data after all
+        except OSError as e:
+            raise serial.SerialException(f'read failed: {e}') from e
+        if not chunk:
+            raise serial.SerialException('device reports readiness to read but returned no data (device disconnected?)')
+
+        *lines, buf = (buf + chunk).split(b'\n')
+        for line in lines:
+            yield line.decode('ascii').rstrip()
+
+
+def read_serial(dev: serial.Serial, states: CounterStates, on_data: Optional[Callable[[], None]] = None) -> None:
+    """Process telegrams from `dev`; `on_data` is called once the first line has been processed."""
+    match_telegram = TELEGRAM_RE.fullmatch
+    states_increment = states.increment
+    for line in read_lines(dev):
+        m = match_telegram(line)
+        if m is None:
+            elems = line.split(':')
+            assert len(elems) == 2 and elems[0] == '/42001', f'illegal input: {line}'
             LOG.debug('header received')
         else:
-            assert elems[0] == 'ID', f'illegal input: {line}'
-            assert len(elems) == 19, f'illegal input: {line}'
-            device_id = int(elems[1])
-            interval = int(elems[3])
-            pulses = [int(elems[5 + i*3]) for i in range(5)]
-            pulses_total = [int(elems[6 + i*3]) for i in range(5)]
-            telegram = PulseTelegram(device_id, interval, pulses, pulses_total)
-            states.increment(telegram.pulses)
+            states_increment(list(map(int, m.groups()))[2::2])
+
+        if on_data is not None:
+            on_data()
+            on_data = None
+
+
+def _watch_for_device(device: str) -> bool:
+    """Block until `device` exists, using inotify on its parent directory.
+
+    Returns False if the directory cannot be watched, or stops being watched
+    (e.g. it is removed), so that the caller can fall back to polling.
+    """
+    lost = inotify_flags.IGNORED | inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF
+    try:
+        with INotify() as ino:
+            # udev renames by-id symlinks into place, which is IN_MOVED_TO
+            ino.add_watch(os.path.dirname(device) or '.', inotify_flags.CREATE | inotify_flags.MOVED_TO | inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF)
+            # the device may have appeared before the watch was added, so check
+            # before blocking on the next batch of events
+            while not os.path.exists(device):
+                if any(event.mask & lost for event in ino.read()):
+                    return False
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_device(device: str) -> None:
+    while not os.path.exists(device):
+        if INotify is None or not _watch_for_device(device):
+            time.sleep(1)
+
 
+def run_serial(device: str, states: CounterStates) -> None:
+    retry_delay = RETRY_MIN_DELAY
+
+    def reset_retry_delay() -> None:
+        nonlocal retry_delay
+        retry_delay = RETRY_MIN_DELAY
 
-def run_serial(device: str, states: CounterStates):
     while True:
         if not os.path.exists(device):
             LOG.warning(f'not found: {device} (will keep trying)')
-            while not os.path.exists(device):
-                time.sleep(1)
+            wait_for_device(device)
 
         try:
             with serial.Serial(device, baudrate=9600, bytesize=serial.SEVENBITS, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_ONE) as ser:
-                read_serial(ser, states)
+                # only a connection that delivers data counts as recovered; a
+                # port that opens but fails on read keeps backing off
+                read_serial(ser, states, on_data=reset_retry_delay)
         except KeyboardInterrupt:
             break
         except serial.serialutil.SerialException as e:
-            LOG.warning(f'serial error: {e} (will try again in 10 seconds)')
-            time.sleep(10)
+            if not os.path.exists(device):
+                # device unplugged; wait for it to reappear at the top of the loop
+                LOG.warning(f'serial error: {e}')
+                continue
+
+            # the device is still there, so retry soon, backing off while
+            # the error persists
+            LOG.warning(f'serial error: {e} (will try again in {retry_delay:g} seconds)')
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, RETRY_MAX_DELAY)
         except Exception as e:
             LOG.warning(f's0 counter error {e} (will try again in 10 seconds)', e)
             time.sleep(10)
@@ -162,28 +362,41 @@ if __name__ == '__main__':
     parser.add_argument('--state', metavar='PATH', default=default_state_file, help=f'path to persistent state file (default: {default_state_file})')
     parser.add_argument('--port', metavar='PORT', default=DEFAULT_PORT, type=int, help=f'port for rest API to listen on (default: {DEFAULT_PORT})')
     parser.add_argument('--logfile', metavar='PATH', default=default_log_file, help=f'log file (default: {default_log_file})')
+    parser.add_argument('--loglevel', metavar='LEVEL', default='DEBUG', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='console log level; the log file never records below INFO (default: DEBUG)')
     args = parser.parse_args()
 
-    logging.getLogger().setLevel(logging.DEBUG)
+    logging.getLogger().setLevel(min(logging.getLevelName(args.loglevel), logging.INFO))
     log_formatter = logging.Formatter("%(asctime)s [%(levelname)-4.4s]  %(message)s")
 
     file_handler = logging.handlers.RotatingFileHandler(args.logfile, maxBytes=1024*1024, backupCount=3)
     file_handler.setFormatter(log_formatter)
-    file_handler.setLevel(logging.WARN)
-    logging.getLogger().addHandler(file_handler)
+    file_handler.setLevel(logging.INFO)
 
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(log_formatter)
-    file_handler.setLevel(logging.INFO)
-    logging.getLogger().addHandler(console_handler)
+    console_handler.setLevel(args.loglevel)
+
+    # emit records from a background thread, so that writing or rotating the
+    # log file never blocks the serial reader or the request handlers
+    log_queue: queue.Queue[logging.LogRecord] = queue.Queue(-1)
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    log_listener.start()
 
     LOG.info('launching pulse counter service')
     states = CounterStates(args.state)
 
-    t1 = threading.Thread(target=run_serial, args=(args.device, states))
+    t1 = threading.Thread(target=run_serial, args=(args.device, states), daemon=True)
     t1.start()
 
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     handler = partial(Handler, states)
-    with socketserver.TCPServer(("", args.port), handler) as httpd:
-        LOG.info(f'serving at port {args.port}')
-        httpd.serve_forever()
+    try:
+        with http.server.ThreadingHTTPServer(("", args.port), handler) as httpd:
+            httpd.daemon_threads = True
+            LOG.info(f'serving at port {args.port}')
+            httpd.serve_forever()
+    finally:
+        states.flush()
+        log_listener.stop()